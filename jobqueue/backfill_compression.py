@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Compress job bodies, responses and log messages that were stored before
+compression was turned on.
+
+Safe to run against a live queue, and to re-run; values already
+compressed, or changed while the tool runs, are left alone.
+"""
+
+import logging
+from optparse import OptionParser
+import sys
+from textwrap import dedent
+
+from jobqueue import db
+from jobqueue.queue_processor import _parse_config
+
+
+logging.basicConfig(level=logging.INFO,
+                    stream=sys.stderr,
+                    format="%(asctime)s  %(message)s")
+
+
+COLUMNS_BY_TABLE = [
+    ('queued_job', ['body', 'last_response']),
+    ('queued_job_log', ['msg']),
+]
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def backfill_table(store, table, columns, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Compress the given columns of every row of table, a batch of rows
+    at a time.  Returns the number of rows updated.
+    """
+    total_updated = 0
+    last_id = 0
+    while True:
+        last_id, num_updated = store.compress_rows(table, columns,
+                                                   after_id=last_id,
+                                                   limit=batch_size)
+        if last_id is None:
+            return total_updated
+        total_updated += num_updated
+        logging.info("%s: compressed %d rows, up to id %s",
+                     table, total_updated, last_id)
+
+
+def main(conf_fname, batch_size=DEFAULT_BATCH_SIZE):
+    logging.info("Reading config from %s", conf_fname)
+    config = _parse_config(conf_fname)
+    store = None
+
+    try:
+        store = db.open_storage(config)
+        for table, columns in COLUMNS_BY_TABLE:
+            num_updated = backfill_table(store, table, columns, batch_size)
+            logging.info("Done with %s, compressed %d rows.",
+                         table, num_updated)
+    finally:
+        if store:
+            store.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=dedent("""\
+                                       [options] conf_file
+                                       -h or --help for help.
+
+                                       Compresses large values stored before compression
+                                       was turned on.
+
+                                       conf_file is the same file the queue processor uses.
+                                       """))
+    parser.add_option("-b", "--batch-size",
+                      type="int", default=DEFAULT_BATCH_SIZE,
+                      dest="batch_size",
+                      help="Rows to compress per batch (default %s)" % DEFAULT_BATCH_SIZE)
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Must pass exactly one conf file.")
+
+    main(conf_fname=args[0],
+         batch_size=opts.batch_size)
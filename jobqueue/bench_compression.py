@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Measure what compression costs and saves for job bodies of various
+sizes: bytes stored, and time to queue (add_job) and read back
+(find_job) a job, with and without compression.
+
+Runs against the db-test section of the conf file, with whichever
+engine that names.  The jobs it queues are deleted again afterwards.
+"""
+
+import json
+import logging
+from optparse import OptionParser
+import random
+import sys
+from textwrap import dedent
+import timeit
+
+from jobqueue import compression, db
+from jobqueue.queue_processor import _parse_config
+
+
+logging.basicConfig(level=logging.INFO,
+                    stream=sys.stderr,
+                    format="%(asctime)s  %(message)s")
+
+
+# Servers per stack description; roughly 3KB, 30KB and 300KB bodies.
+DEFAULT_SERVER_COUNTS = [25, 250, 2500]
+DEFAULT_NUM_JOBS = 200
+REPEAT = 5
+
+
+def _make_body(num_servers):
+    # A stack description like the ones jobs get posted, with enough
+    # variety that it doesn't compress unrealistically well.
+    rand = random.Random(num_servers)
+    return json.dumps({
+        "stack": "prod",
+        "servers": [{"name": "web%d" % i,
+                     "size": "m1.large",
+                     "region": "us-east-1",
+                     "ip": "10.0.%d.%d" % (i // 250, i % 250),
+                     "tags": ["web", "php", "lb"],
+                     "uptime": rand.randint(0, 10 ** 6)}
+                    for i in range(num_servers)]})
+
+
+def _bench(store, body, num_jobs, compress_threshold):
+    """
+    Returns (average stored body length, usecs per add_job, usecs per
+    find_job) for num_jobs jobs with the given body.
+    """
+    store.compress_threshold = compress_threshold
+    job_ids = []
+
+    def _add():
+        job_ids.append(store.add_job('post', 'http://localhost/bench',
+                                     body=body))
+
+    try:
+        add_secs = min(timeit.repeat(_add, number=num_jobs, repeat=REPEAT))
+        find_secs = min(timeit.repeat(
+            lambda: [store.find_job(job_id) for job_id in job_ids],
+            number=1, repeat=REPEAT))
+        store._execute("SELECT AVG(LENGTH(body)) FROM queued_job "
+                       "WHERE id >= %s AND id <= %s",
+                       (job_ids[0], job_ids[-1]))
+        stored_len = store.curs.fetchone()[0]
+    finally:
+        if job_ids:
+            store._execute("DELETE FROM queued_job WHERE id >= %s AND id <= %s",
+                           (job_ids[0], job_ids[-1]))
+
+    return (float(stored_len),
+            add_secs * 1e6 / num_jobs,
+            find_secs * 1e6 / len(job_ids))
+
+
+def main(conf_fname, num_jobs=DEFAULT_NUM_JOBS,
+         server_counts=DEFAULT_SERVER_COUNTS):
+    logging.info("Reading config from %s", conf_fname)
+    config = _parse_config(conf_fname)
+    db.start_test()
+    store = None
+
+    try:
+        store = db.open_storage(config)
+        print("%8s  %-5s  %9s  %7s  %10s  %10s" % (
+            "body", "mode", "stored", "ratio", "add_job", "find_job"))
+        for num_servers in server_counts:
+            body = _make_body(num_servers)
+            plain = None
+            for mode, threshold in [("plain", sys.maxint),
+                                    ("zlib", compression.THRESHOLD_BYTES)]:
+                stored_len, add_usecs, find_usecs = _bench(store, body,
+                                                           num_jobs, threshold)
+                if plain is None:
+                    plain = stored_len
+                print("%8d  %-5s  %9d  %6.1fx  %8.1fus  %8.1fus" % (
+                    len(body), mode, stored_len, plain / stored_len,
+                    add_usecs, find_usecs))
+    finally:
+        if store:
+            store.close()
+        db.end_test()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=dedent("""\
+                                       [options] conf_file
+                                       -h or --help for help.
+
+                                       Benchmarks storing and reading back job bodies with
+                                       and without compression.
+
+                                       conf_file should contain a db-test section; the jobs
+                                       queued there are deleted again afterwards.
+                                       """))
+    parser.add_option("-n", "--num-jobs",
+                      type="int", default=DEFAULT_NUM_JOBS,
+                      dest="num_jobs",
+                      help="Jobs to queue per body size (default %s)" % DEFAULT_NUM_JOBS)
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Must pass exactly one conf file.")
+
+    main(conf_fname=args[0],
+         num_jobs=opts.num_jobs)
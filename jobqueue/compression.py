@@ -0,0 +1,68 @@
+"""
+Transparent compression of large text values (job bodies, responses
+and log messages) stored in TEXT columns.
+
+Compressed values are zlib compressed, base64 encoded (so they are
+still valid TEXT) and prefixed with a marker: MARKER for text values,
+which are compressed as UTF-8, or BYTES_MARKER for byte strings, which
+are compressed as is.  Either way the value reads back with the type
+it was stored with.  Anything without a marker is read back as is, so
+rows written before compression was turned on, or below the threshold,
+still read correctly.
+"""
+
+import base64
+import zlib
+
+
+MARKER = "zlib64:"
+BYTES_MARKER = "zlib64b:"
+
+
+# Values shorter than this (in bytes) aren't worth compressing.
+THRESHOLD_BYTES = 1024
+
+
+def is_compressed(value):
+    """
+    True if value was written by compress.
+    """
+    return value is not None and (value.startswith(MARKER) or
+                                  value.startswith(BYTES_MARKER))
+
+
+def compress(value, threshold=THRESHOLD_BYTES):
+    """
+    The form of value to store: compressed if it is at least threshold
+    bytes long, as is otherwise.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        raw = value
+        marker = BYTES_MARKER
+    else:
+        raw = value.encode('utf-8')
+        marker = MARKER
+    # Plain values that happen to start with a marker are always
+    # compressed, so that they can't be mistaken for compressed ones.
+    looks_compressed = (raw.startswith(MARKER.encode('ascii')) or
+                        raw.startswith(BYTES_MARKER.encode('ascii')))
+    if len(raw) < threshold and not looks_compressed:
+        return value
+    packed = base64.b64encode(zlib.compress(raw)).decode('ascii')
+    if len(marker) + len(packed) >= len(raw) and not looks_compressed:
+        return value
+    return str(marker + packed)
+
+
+def decompress(value):
+    """
+    The original form of a stored value.
+    """
+    if value is not None and value.startswith(BYTES_MARKER):
+        return zlib.decompress(base64.b64decode(value[len(BYTES_MARKER):]))
+    if not is_compressed(value):
+        return value
+    packed = value[len(MARKER):]
+    return zlib.decompress(base64.b64decode(packed)).decode('utf-8')
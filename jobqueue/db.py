@@ -1,4 +1,10 @@
-import MySQLdb
+try:
+    import MySQLdb
+except ImportError:
+    # Only needed for the mysql engine.
+    MySQLdb = None
+
+from jobqueue.storage import MySQLStorage, SQLiteStorage
 
 in_test = False
 
@@ -20,16 +26,44 @@ def _settings_from_section(config, section):
                 db=config.get(section, 'db'))
 
 
-def open_conn(config):
+def _db_section(config):
     if in_test:
         if not config.has_section('db-test'):
             raise Exception("In test and no db-test config!")
-        db = MySQLdb.connect(**_settings_from_section(config, 'db-test'))
+        return 'db-test'
     else:
         if not config.has_section('db'):
             raise Exception("Not in test and no db config!")
-        db = MySQLdb.connect(**_settings_from_section(config, 'db'))
+        return 'db'
+
+
+def _engine(config, section):
+    if config.has_option(section, 'engine'):
+        return config.get(section, 'engine')
+    return 'mysql'
+
+
+def open_conn(config):
+    section = _db_section(config)
+    if MySQLdb is None:
+        raise Exception("MySQLdb is not installed!")
+    db = MySQLdb.connect(**_settings_from_section(config, section))
 
     db.autocommit(True)
 
     return db
+
+
+def open_storage(config):
+    """
+    Open the Storage for the engine named in the db config section
+    (mysql, the default, or sqlite).
+    """
+    section = _db_section(config)
+    engine = _engine(config, section)
+    if engine == 'mysql':
+        return MySQLStorage(open_conn(config))
+    elif engine == 'sqlite':
+        return SQLiteStorage(config.get(section, 'path'))
+    else:
+        raise Exception("Unknown db engine %s!" % engine)
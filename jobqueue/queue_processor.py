@@ -4,16 +4,23 @@
 Module for processing requests to the stack queue.
 """
 
-from collections import namedtuple
 from ConfigParser import SafeConfigParser
+from contextlib import contextmanager
 import logging
-from multiprocessing import Pool
+from multiprocessing import Pool, Queue as ProcessQueue
 from optparse import OptionParser
+import os
+from Queue import Queue, Empty
 import requests
+import signal
 import sys
 from textwrap import dedent
+import time
+import uuid
 
 from jobqueue import db
+from jobqueue.scheduler import DueScheduler
+from jobqueue.storage import SUCCESS, PERMANENT_FAILURE, TEMPORARY_FAILURE
 
 
 logging.basicConfig(level=logging.INFO,
@@ -21,58 +28,29 @@ logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s  %(message)s")
 
 
-# Result codes for the db.
-SUCCESS = 0
-PERMANENT_FAILURE = 1
-TEMPORARY_FAILURE = 2
-
-
 LOCK_TIMEOUT_SECS = 10
 
 
-JobInfo = namedtuple('JobInfo', ['id', 'http_method', 'url', 'body',
-                                 'timeout_secs', 'last_started_at', 'result_code',
-                                 'remaining_retries', 'retry_delay_secs'])
+# How long past its deadline a job may keep its worker process before
+# the worker is killed, and how often the parent checks for that.
+KILL_GRACE_SECS = 10
+SUPERVISE_INTERVAL_SECS = 1
 
 
 # This can come from config if we like.
 DEFAULT_POOL_SIZE = 5
 
 
-def _log_to_db(curs, job_id, msg):
+# When running continuously, how often to re-read the due times of
+# pending jobs from the db, and how far ahead to look when doing so.
+RECONCILE_SECS = 60
+LOOKAHEAD_SECS = 120
+
+
+def _log_to_db(store, job_id, msg):
     msg = "[JOBID %s] %s" % (job_id, msg)
     logging.info(msg)
-    insert = """
-             INSERT INTO queued_job_log
-               (job_id, msg)
-             VALUES
-               (%s, %s)
-             """
-    curs.execute(insert, (job_id, msg))
-
-
-def _find_job(curs, job_id):
-    select = """
-             SELECT id, http_method, url, body, timeout_secs,
-                        last_started_at, result_code, remaining_retries,
-                        retry_delay_secs
-             FROM queued_job
-             WHERE id = %s
-             """
-    curs.execute(select, (job_id,))
-    row = curs.fetchone()
-    if not row:
-        return None
-    else:
-        return JobInfo(id=row[0],
-                       http_method=row[1],
-                       url=row[2],
-                       body=row[3],
-                       timeout_secs=row[4],
-                       last_started_at=row[5],
-                       result_code=row[6],
-                       remaining_retries=row[7],
-                       retry_delay_secs=row[8])
+    store.log(job_id, msg)
 
 
 class JobResult(object):
@@ -87,6 +65,8 @@ class JobResult(object):
         self.text = text
         self.new_retry_delay_secs = new_retry_delay_secs
         self.new_url = new_url
+        # Seconds until the job may be retried, or None if it won't be.
+        self.retry_in_secs = None
 
     def is_success(self):
         """
@@ -106,24 +86,38 @@ class JobResult(object):
         return not self.is_timeout and self.status_code != 503
 
 
-def _mark_started(curs, job_id):
-    mark = """
-           UPDATE queued_job
-             SET last_started_at = NOW()
-             WHERE id = %s
-           """
-    curs.execute(mark, (job_id,))
+class DeadlineExceeded(Exception):
+    """
+    Raised in a worker when a job runs past its total deadline.
+    """
+
+
+@contextmanager
+def _deadline(secs):
+    # Unlike the requests timeout, which applies to each socket
+    # operation, this bounds the whole call: connect, send, headers
+    # and body.
+    def _expired(signum, frame):
+        raise DeadlineExceeded()
+
+    old_handler = signal.signal(signal.SIGALRM, _expired)
+    signal.setitimer(signal.ITIMER_REAL, secs)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
 
 
-def _call_job(curs, job_info, config):
+def _call_job(store, job_info, config):
     # open up an http connection, hit the endpoint, with a timeout.
     # return the JobResult object that we get from parsing the json
     # returned.
     new_retry_delay_secs = None
     text = None
 
-    _mark_started(curs, job_info.id)
-    _log_to_db(curs, job_info.id,
+    store.mark_started(job_info.id)
+    _log_to_db(store, job_info.id,
                "Calling job with method %s on url %s (timeout %s)" %
                (job_info.http_method,
                 job_info.url,
@@ -136,18 +130,20 @@ def _call_job(curs, job_info, config):
     }
 
     try:
-        resp = requests.request(job_info.http_method,
-                                job_info.url,
-                                data=job_info.body,
-                                auth=credentials,
-                                headers=headers,
-                                timeout=float(job_info.timeout_secs))
+        with _deadline(float(job_info.timeout_secs)):
+            resp = requests.request(job_info.http_method,
+                                    job_info.url,
+                                    data=job_info.body,
+                                    auth=credentials,
+                                    headers=headers,
+                                    timeout=float(job_info.timeout_secs))
         text = resp.text
         # if the request has temporarily failed, and asked for a new
         # retry delay OR to update url, respect it
-        new_retry_delay_secs = resp.headers['x-bitlancer-retry-delay-secs']
+        new_retry_delay_secs = _parse_retry_delay_secs(
+            store, job_info.id, resp.headers['x-bitlancer-retry-delay-secs'])
         new_url = resp.headers['x-bitlancer-url']
-    except requests.Timeout:
+    except (requests.Timeout, DeadlineExceeded):
         return JobResult(is_timeout=True)
 
     return JobResult(status_code=resp.status_code,
@@ -156,6 +152,19 @@ def _call_job(curs, job_info, config):
                      new_url=new_url)
 
 
+def _parse_retry_delay_secs(store, job_id, value):
+    # The retry delay a job asked for, or None if it didn't ask for one
+    # we can use.
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        _log_to_db(store, job_id,
+                   "Ignoring bad retry delay %r from job" % value)
+        return None
+
+
 def _credentials_from_config(config):
     section = 'api'
     if config.has_section(section):
@@ -164,46 +173,20 @@ def _credentials_from_config(config):
         return None
 
 
-def _set_result_code(curs, job_id, result_code):
-    mark_done = """
-                UPDATE queued_job
-                  SET result_code = %s
-                  WHERE id = %s
-                """
-    curs.execute(mark_done, (result_code, job_id))
-
-
-def _mark_finished(curs, job_id):
-    mark = """
-           UPDATE queued_job
-             SET last_finished_at = NOW()
-             WHERE id = %s
-           """
-    curs.execute(mark, (job_id,))
-
-
-def _log_success(curs, job_id, result):
+def _log_success(store, job_id, result, run_token=None):
     """
-    Log a success for job_id.
+    Log a success for job_id, from the run identified by run_token.
     """
-    _mark_finished(curs, job_id)
-    _set_result_code(curs, job_id, SUCCESS)
-    _log_to_db(curs, job_id, "Job succeeded: %s" % result.text)
-
-
-def _decrement_retries(curs, job_id):
-    decrement = """
-                UPDATE queued_job
-                  SET remaining_retries = remaining_retries - 1
-                  WHERE id = %s
-                """
-    curs.execute(decrement, (job_id,))
+    store.record_result(job_id, SUCCESS, run_token=run_token)
+    _log_to_db(store, job_id, "Job succeeded: %s" % result.text)
 
 
-def _log_failure(curs, job_id, result):
+def _log_failure(store, job_info, result, run_token=None):
     """
-    Log a failure for job_id.
+    Log a failure for the job described by job_info, from the run
+    identified by run_token.
     """
+    job_id = job_info.id
     msg = "Job failed"
     if result.is_permanent_failure():
         result_code = PERMANENT_FAILURE
@@ -214,22 +197,22 @@ def _log_failure(curs, job_id, result):
     else:
         result_code = TEMPORARY_FAILURE
         msg += (" temporarily: %s"  % result.text)
-    _log_to_db(curs, job_id, msg)
-    _set_result_code(curs, job_id, result_code)
-    _decrement_retries(curs, job_id)
-    _mark_finished(curs, job_id)
+    _log_to_db(store, job_id, msg)
+    store.record_result(job_id, result_code, used_retry=True,
+                        run_token=run_token)
 
 
-def _fmt_lock_id(job_id):
-    return "lock_job_%s" % job_id
-
-
-def _lock_job(curs, job_id):
-    acquire_lock = """
-                   SELECT GET_LOCK(%s, %s)
-                   """
-    curs.execute(acquire_lock, (_fmt_lock_id(job_id), LOCK_TIMEOUT_SECS))
-    return curs.fetchone()[0] == 1
+def _retry_in_secs(job_info, result):
+    """
+    The number of seconds until the job described by job_info may be
+    retried after result, or None if it won't be retried.
+    """
+    if (result.is_success() or result.is_permanent_failure() or
+            job_info.remaining_retries <= 1):
+        return None
+    if result.new_retry_delay_secs is not None:
+        return result.new_retry_delay_secs
+    return job_info.retry_delay_secs
 
 
 def _is_workable(job_info):
@@ -238,107 +221,331 @@ def _is_workable(job_info):
             job_info.remaining_retries > 0)
 
 
-def process_one(job_id_and_config):
+# Set in pool workers; where they report the jobs they start and
+# finish, so the parent can kill a worker wedged past its deadline.
+_worker_events = None
+
+
+def _init_worker(worker_events):
+    global _worker_events
+    _worker_events = worker_events
+
+
+def _report_started(job_id, run_token, timeout_secs):
+    # The start time is taken here rather than when the parent gets
+    # round to reading the event, which may be much later.
+    if _worker_events is not None:
+        _worker_events.put((job_id, os.getpid(), run_token, time.time(),
+                            timeout_secs))
+
+
+def _report_finished(job_id, run_token):
+    if _worker_events is not None:
+        _worker_events.put((job_id, os.getpid(), run_token, None, None))
+
+
+def process_one(job_id_and_config, schedule_retries=False):
+    """
+    Work the job, if it is workable, returning its JobResult (or None
+    if it wasn't worked).
+
+    If schedule_retries, the result's retry_in_secs is filled in for
+    the in-memory scheduler.
+    """
     job_id, config = job_id_and_config
+    # Recorded with the job's result, so that the supervisor can tell
+    # whether this run got that far before its worker was killed.
+    run_token = uuid.uuid4().hex
 
-    conn = None
-    curs = None
+    store = None
 
     try:
-        conn = db.open_conn(config)
-        curs = conn.cursor()
-        if not _lock_job(curs, job_id):
-            _log_to_db(curs, job_id, "Could not acquire lock on job")
+        store = db.open_storage(config)
+        if not store.claim(job_id, LOCK_TIMEOUT_SECS):
+            _log_to_db(store, job_id, "Could not acquire lock on job")
             return None
-        job_info = _find_job(curs, job_id)
+        job_info = store.find_job(job_id)
         if not job_info:
-            _log_to_db(curs, job_id, "Could not find job")
+            _log_to_db(store, job_id, "Could not find job")
             return None
         if not _is_workable(job_info):
-            _log_to_db(curs, job_id, "Job not workable, skipping")
+            _log_to_db(store, job_id, "Job not workable, skipping")
             return None
-        result = _call_job(curs, job_info, config)
-        _maybe_update_job(curs, job_id, result)
+        _report_started(job_id, run_token, job_info.timeout_secs)
+        result = _call_job(store, job_info, config)
+        _maybe_update_job(store, job_id, result)
         if result.is_success():
-            _log_success(curs, job_id, result)
+            _log_success(store, job_id, result, run_token)
         else:
-            _log_failure(curs, job_id, result)
+            _log_failure(store, job_info, result, run_token)
+        if schedule_retries:
+            result.retry_in_secs = _retry_in_secs(job_info, result)
         return result
     finally:
         # This will automatically release the lock, if one was
         # acquired.
-        if curs:
-            curs.close()
-        if conn:
-            conn.close()
-
-
-def _maybe_update_job(curs, job_id, result):
-    set_strs = []
-    set_params = []
-    if result.text is not None:
-        set_strs.append("last_response = %s")
-        set_params.append(result.text)
-    if result.new_retry_delay_secs is not None:
-        set_strs.append("retry_delay_secs = %s")
-        set_params.append(result.new_retry_delay_secs)
-    if result.new_url is not None:
-        set_strs.append("url = %s")
-        set_params.append(result.new_url)
-    if set_strs:
-        set_params.append(job_id)
-        query = "UPDATE queued_job SET " + ', '.join(set_strs) + " WHERE id = %s"
-        curs.execute(query,tuple(set_params))
-
-
-def _find_all_pending(curs):
-    select = """
-             SELECT id
-             FROM queued_job
-               WHERE
-                  (result_code IS NULL OR result_code = %s)
-                AND
-                  remaining_retries > 0
-                AND
-                  (last_finished_at IS NULL OR
-                   DATE_ADD(last_finished_at,
-                            INTERVAL retry_delay_secs SECOND) <= NOW())
-             """
-    curs.execute(select, (TEMPORARY_FAILURE,))
-    rows = curs.fetchall()
-    return [r[0] for r in rows]
+        if store:
+            store.close()
+        _report_finished(job_id, run_token)
+
+
+def _maybe_update_job(store, job_id, result):
+    store.update_job(job_id,
+                     last_response=result.text,
+                     retry_delay_secs=result.new_retry_delay_secs,
+                     url=result.new_url)
+
+
+def _record_killed(job_id, pid, run_token, config):
+    """
+    Record a timeout for job_id, whose worker (pid) was killed for
+    overrunning its deadline during the run identified by run_token.
+
+    Returns the timeout JobResult, or None if the worker had already
+    recorded the job's result before it was killed.
+    """
+    result = JobResult(is_timeout=True)
+
+    store = None
+
+    try:
+        store = db.open_storage(config)
+        _log_to_db(store, job_id,
+                   "Killed worker %s after job overran its deadline" % pid)
+        # The lock went away with the killed worker.
+        if not store.claim(job_id, LOCK_TIMEOUT_SECS):
+            _log_to_db(store, job_id, "Could not acquire lock on job")
+            return result
+        job_info = store.find_job(job_id)
+        if not job_info:
+            _log_to_db(store, job_id, "Could not find job")
+            return result
+        if (job_info.last_run_token == run_token or
+                not _is_workable(job_info)):
+            _log_to_db(store, job_id,
+                       "Job finished before its worker was killed")
+            return None
+        _log_failure(store, job_info, result)
+        result.retry_in_secs = _retry_in_secs(job_info, result)
+        return result
+    finally:
+        if store:
+            store.close()
+
+
+class WorkerSupervisor(object):
+    """
+    Tracks which pool worker is running which job, from the events the
+    workers report, and kills workers that hang on to a job for longer
+    than its deadline plus KILL_GRACE_SECS.
+
+    The pool replaces killed workers, so the rest of the batch carries
+    on.
+    """
+
+    def __init__(self, worker_events, config):
+        self.worker_events = worker_events
+        self.config = config
+        # job_id -> (pid, run_token, kill_at)
+        self._running = {}
+
+    def _drain_events(self):
+        while True:
+            try:
+                (job_id, pid, run_token,
+                 started_at, timeout_secs) = self.worker_events.get_nowait()
+            except Empty:
+                return
+            if started_at is None:
+                running = self._running.get(job_id)
+                if running is not None and running[1] == run_token:
+                    del self._running[job_id]
+            else:
+                self._running[job_id] = (pid, run_token,
+                                         started_at + timeout_secs +
+                                         KILL_GRACE_SECS)
+
+    def secs_until_next_kill(self):
+        """
+        Seconds until the next running job is due to be killed, or None
+        if no jobs are running.
+        """
+        self._drain_events()
+        if not self._running:
+            return None
+        next_kill_at = min(kill_at for _, _, kill_at in self._running.values())
+        return max(next_kill_at - time.time(), 0)
+
+    def reap(self):
+        """
+        Kill the workers of any jobs past their kill time and record
+        those jobs as timed out.
+
+        Returns a list of (job_id, JobResult) for the killed jobs.
+        """
+        self._drain_events()
+        now = time.time()
+        overdue = [(job_id, running)
+                   for job_id, running in self._running.items()
+                   if running[2] <= now]
+        reaped = []
+        for job_id, running in overdue:
+            # The job may have finished since we last looked.
+            self._drain_events()
+            if self._running.get(job_id) != running:
+                continue
+            del self._running[job_id]
+            pid, run_token, _ = running
+            logging.warning("[JOBID %s] Killing wedged worker %s", job_id, pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                # Already gone.
+                pass
+            try:
+                result = _record_killed(job_id, pid, run_token, self.config)
+            except Exception:
+                # The job will be found again by the next reconcile.
+                logging.exception("[JOBID %s] Error recording killed job",
+                                  job_id)
+                result = None
+            reaped.append((job_id, result))
+        return reaped
+
+
+def _make_pool(num_procs, config):
+    logging.info("Initializing pool of size %d", num_procs)
+    worker_events = ProcessQueue()
+    pool = Pool(num_procs, _init_worker, (worker_events,))
+    return pool, WorkerSupervisor(worker_events, config)
 
 
 def process_all(pool, config):
     logging.info("Processing all...")
 
-    conn = None
-    curs = None
+    store = None
 
     try:
         logging.info("Opening connection to db...")
-        conn = db.open_conn(config)
-        curs = conn.cursor()
+        store = db.open_storage(config)
         logging.info("Done opening db connection.")
         # we don't worry about race conditions on starting jobs, since
         # the locking in the single processor will make sure that only
         # one job at a time is actually processing.
         logging.info("Finding pending jobs...")
-        pending_job_ids = _find_all_pending(curs)
+        pending_job_ids = store.find_pending()
         logging.info("Done, found %d pending jobs: %s.",
                      len(pending_job_ids),
                      pending_job_ids)
-        return pool.map_async(process_one, [(job_id, config)
-                                            for job_id
-                                            in pending_job_ids])
+        return [(job_id, pool.apply_async(process_one, [(job_id, config)]))
+                for job_id in pending_job_ids]
     finally:
-        if curs:
-            curs.close()
-        if conn:
-            conn.close()
+        if store:
+            store.close()
         logging.info("Done processing all.")
 
 
+def _reconcile(scheduler, config, lookahead_secs):
+    """
+    Refresh scheduler with the due times of jobs the db says are due
+    within lookahead_secs.
+    """
+    store = None
+
+    try:
+        store = db.open_storage(config)
+        upcoming = store.find_upcoming(lookahead_secs)
+    finally:
+        if store:
+            store.close()
+
+    for job_id, secs_until_due in upcoming:
+        scheduler.schedule_in(job_id, secs_until_due)
+    logging.info("Reconciled with db, %d jobs due within %d secs.",
+                 len(upcoming), lookahead_secs)
+
+
+def _process_one_keyed(job_id_and_config):
+    # Like process_one, but always hands back the job id so the
+    # scheduler can account for the job, even if processing blew up.
+    job_id = job_id_and_config[0]
+    try:
+        return job_id, process_one(job_id_and_config, schedule_retries=True)
+    except Exception:
+        logging.exception("[JOBID %s] Error processing job", job_id)
+        return job_id, None
+
+
+def process_forever(num_procs, config,
+                    reconcile_secs=RECONCILE_SECS,
+                    lookahead_secs=LOOKAHEAD_SECS,
+                    stop_at=None):
+    """
+    Process jobs continuously, sleeping until the next job is due.
+
+    Due times are kept in memory, fed by the retry delays of jobs that
+    fail here and by a periodic, bounded lookahead query against the
+    db (which also picks up newly queued jobs).  Errors talking to the
+    db are logged and retried at the next reconcile, rather than
+    stopping the processor.
+
+    Runs until stop_at (a time.time() value), if given, else forever.
+    """
+    pool, supervisor = _make_pool(num_procs, config)
+    scheduler = DueScheduler()
+    finished = Queue()
+    in_flight = set()
+    next_reconcile_at = 0
+
+    while stop_at is None or time.time() < stop_at:
+        if time.time() >= next_reconcile_at:
+            next_reconcile_at = time.time() + reconcile_secs
+            try:
+                _reconcile(scheduler, config, lookahead_secs)
+            except Exception:
+                logging.exception("Error reconciling with db, retrying in "
+                                  "%s secs", reconcile_secs)
+
+        for job_id in scheduler.pop_due():
+            # A job already running will be rescheduled from its
+            # result, if it needs to be.
+            if job_id in in_flight:
+                continue
+            in_flight.add(job_id)
+            pool.apply_async(_process_one_keyed, [(job_id, config)],
+                             callback=finished.put)
+
+        wait_secs = next_reconcile_at - time.time()
+        if stop_at is not None:
+            wait_secs = min(wait_secs, stop_at - time.time())
+        for secs in [scheduler.secs_until_next_due(),
+                     supervisor.secs_until_next_kill()]:
+            if secs is not None:
+                wait_secs = min(wait_secs, secs)
+        if in_flight:
+            # Workers report the jobs they start through a queue we only
+            # read between waits, so keep the waits short enough to
+            # notice a newly started job in time to kill it.
+            wait_secs = min(wait_secs, SUPERVISE_INTERVAL_SECS)
+
+        try:
+            done = supervisor.reap()
+        except Exception:
+            logging.exception("Error supervising workers")
+            done = []
+        try:
+            done.append(finished.get(timeout=max(wait_secs, 0)))
+        except Empty:
+            pass
+        for job_id, result in done:
+            in_flight.discard(job_id)
+            if result is not None and result.retry_in_secs is not None:
+                scheduler.schedule_in(job_id, result.retry_in_secs)
+
+    pool.terminate()
+    pool.join()
+
+
 def _parse_config(conf_fname):
     config_parser = SafeConfigParser()
 
@@ -348,16 +555,38 @@ def _parse_config(conf_fname):
     return config_parser
 
 
+def _collect(async_results, supervisor):
+    """
+    Wait for the results of a batch, killing wedged workers as needed.
+
+    Returns the results in the order of async_results; jobs whose
+    workers were killed get a timeout JobResult.
+    """
+    results = {}
+    while len(results) < len(async_results):
+        for job_id, job_result in supervisor.reap():
+            results[job_id] = job_result
+        for job_id, async_result in async_results:
+            if job_id in results:
+                continue
+            async_result.wait(SUPERVISE_INTERVAL_SECS)
+            if async_result.ready():
+                results[job_id] = async_result.get()
+            break
+    return [results[job_id] for job_id, _ in async_results]
+
+
 def process_with_pool(num_procs, config):
-    logging.info("Initializing pool of size %d", num_procs)
-    pool = Pool(num_procs)
-    result = process_all(pool, config)
-    return result.get()
+    pool, supervisor = _make_pool(num_procs, config)
+    async_results = process_all(pool, config)
+    return _collect(async_results, supervisor)
 
 
-def main(num_procs, conf_fname):
+def main(num_procs, conf_fname, forever=False):
     logging.info("Reading config from %s", conf_fname)
     config = _parse_config(conf_fname)
+    if forever:
+        return process_forever(num_procs, config)
     return process_with_pool(num_procs, config)
 
 
@@ -366,7 +595,9 @@ if __name__ == '__main__':
                                        [options] conf_file
                                        -h or --help for help.
 
-                                       Processes any workable queued jobs and then quits.
+                                       Processes any workable queued jobs and then quits
+                                       (or, with --forever, keeps processing jobs as they
+                                       become due).
 
                                        conf_file should be a path to a ini-like file containing:
 
@@ -385,11 +616,17 @@ if __name__ == '__main__':
                       dest="num_procs",
                       help="Number of processes to run (default %s)" % DEFAULT_POOL_SIZE)
 
+    parser.add_option("-f", "--forever",
+                      action="store_true", default=False,
+                      dest="forever",
+                      help="Keep running, working jobs as they become due")
+
     (opts, args) = parser.parse_args()
 
     if len(args) != 1:
         parser.error("Must pass exactly one conf file.")
 
     main(num_procs=opts.num_procs,
-         conf_fname=args[0])
+         conf_fname=args[0],
+         forever=opts.forever)
 
@@ -0,0 +1,82 @@
+"""
+In-memory bookkeeping of when known jobs next become due.
+"""
+
+import heapq
+import time
+
+
+class DueScheduler(object):
+    """
+    A min-heap of (due_at, job_id) pairs.
+
+    Each job has at most one live due time; scheduling a job again
+    replaces its previous due time.  Superseded heap entries are
+    discarded lazily as they reach the top of the heap.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._heap = []
+        self._due_at = {}
+
+    def __len__(self):
+        return len(self._due_at)
+
+    def __contains__(self, job_id):
+        return job_id in self._due_at
+
+    def schedule(self, job_id, due_at):
+        """
+        Record that job_id becomes due at the absolute time due_at.
+        """
+        self._due_at[job_id] = due_at
+        heapq.heappush(self._heap, (due_at, job_id))
+
+    def schedule_in(self, job_id, secs):
+        """
+        Record that job_id becomes due secs seconds from now.
+        """
+        self.schedule(job_id, self.clock() + max(secs, 0))
+
+    def _drop_stale(self):
+        while self._heap:
+            due_at, job_id = self._heap[0]
+            if self._due_at.get(job_id) == due_at:
+                return
+            heapq.heappop(self._heap)
+
+    def next_due(self):
+        """
+        The earliest due time we know of, or None if nothing is scheduled.
+        """
+        self._drop_stale()
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def secs_until_next_due(self):
+        """
+        Seconds until the earliest known due time (never negative), or
+        None if nothing is scheduled.
+        """
+        due_at = self.next_due()
+        if due_at is None:
+            return None
+        return max(due_at - self.clock(), 0)
+
+    def pop_due(self, now=None):
+        """
+        Remove and return the ids of all jobs due at or before now, in
+        due order.
+        """
+        if now is None:
+            now = self.clock()
+        due = []
+        while True:
+            due_at = self.next_due()
+            if due_at is None or due_at > now:
+                return due
+            _, job_id = heapq.heappop(self._heap)
+            del self._due_at[job_id]
+            due.append(job_id)
@@ -0,0 +1,412 @@
+"""
+Storage backends for the job queue.
+
+Everything the queue processor needs from the db goes through a
+Storage object, so the processor doesn't care whether jobs live in
+MySQL or in a local SQLite file.
+"""
+
+from collections import namedtuple
+import errno
+import fcntl
+import sqlite3
+import time
+
+from jobqueue import compression
+
+
+# Result codes for the db.
+SUCCESS = 0
+PERMANENT_FAILURE = 1
+TEMPORARY_FAILURE = 2
+
+
+JobInfo = namedtuple('JobInfo', ['id', 'http_method', 'url', 'body',
+                                 'timeout_secs', 'last_started_at', 'result_code',
+                                 'remaining_retries', 'retry_delay_secs',
+                                 'last_run_token'])
+
+
+class Storage(object):
+    """
+    Base class for storage backends.
+
+    Queries are written with %s placeholders; subclasses using a
+    different paramstyle translate them in _execute.  The queries that
+    differ between dialects (locking and date arithmetic) are left to
+    subclasses.
+    """
+
+    # Job bodies, responses and log messages at least this long are
+    # stored compressed.
+    compress_threshold = compression.THRESHOLD_BYTES
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.curs = conn.cursor()
+
+    def close(self):
+        """
+        Close the connection, releasing any claims it holds.
+        """
+        self.curs.close()
+        self.conn.close()
+
+    def _execute(self, query, params=()):
+        self.curs.execute(query, params)
+
+    def _compress(self, value):
+        return compression.compress(value, self.compress_threshold)
+
+    def add_job(self, http_method, url, body=None, timeout_secs=60,
+                remaining_retries=10, retry_delay_secs=60):
+        """
+        Queue a new job, returning its id.
+        """
+        insert = """
+                 INSERT INTO queued_job
+                   (http_method, url, body, timeout_secs, remaining_retries,
+                    retry_delay_secs)
+                 VALUES
+                   (%s, %s, %s, %s, %s,
+                    %s)
+                 """
+        self._execute(insert, (http_method, url, self._compress(body),
+                               timeout_secs, remaining_retries,
+                               retry_delay_secs))
+        return self.curs.lastrowid
+
+    def log(self, job_id, msg):
+        """
+        Append msg to the log for job_id.
+        """
+        insert = """
+                 INSERT INTO queued_job_log
+                   (job_id, msg)
+                 VALUES
+                   (%s, %s)
+                 """
+        self._execute(insert, (job_id, self._compress(msg)))
+
+    def claim(self, job_id, timeout_secs):
+        """
+        Take the exclusive lock on job_id, waiting up to timeout_secs.
+
+        The lock is held until the storage is closed (or the process
+        dies).  Returns True if the lock was acquired.
+        """
+        raise NotImplementedError()
+
+    def find_job(self, job_id):
+        """
+        The JobInfo for job_id, or None if there is no such job.
+        """
+        select = """
+                 SELECT id, http_method, url, body, timeout_secs,
+                            last_started_at, result_code, remaining_retries,
+                            retry_delay_secs, last_run_token
+                 FROM queued_job
+                 WHERE id = %s
+                 """
+        self._execute(select, (job_id,))
+        row = self.curs.fetchone()
+        if not row:
+            return None
+        job_info = JobInfo(*row)
+        return job_info._replace(body=compression.decompress(job_info.body))
+
+    def mark_started(self, job_id):
+        """
+        Record that job_id has just been started.
+        """
+        raise NotImplementedError()
+
+    def record_result(self, job_id, result_code, used_retry=False,
+                      run_token=None):
+        """
+        Record that job_id has just finished with result_code, using up
+        one of its retries if used_retry.
+
+        run_token identifies the run that got the result, so that
+        whoever kills a worker can tell whether its run was recorded.
+        """
+        raise NotImplementedError()
+
+    def update_job(self, job_id, last_response=None, retry_delay_secs=None,
+                   url=None):
+        """
+        Update whichever of the given job fields are not None.
+        """
+        set_strs = []
+        set_params = []
+        if last_response is not None:
+            set_strs.append("last_response = %s")
+            set_params.append(self._compress(last_response))
+        if retry_delay_secs is not None:
+            set_strs.append("retry_delay_secs = %s")
+            set_params.append(retry_delay_secs)
+        if url is not None:
+            set_strs.append("url = %s")
+            set_params.append(url)
+        if set_strs:
+            set_params.append(job_id)
+            query = ("UPDATE queued_job SET " + ', '.join(set_strs) +
+                     " WHERE id = %s")
+            self._execute(query, tuple(set_params))
+
+    def find_pending(self):
+        """
+        The ids of all workable jobs that are due now.
+        """
+        raise NotImplementedError()
+
+    def find_upcoming(self, lookahead_secs):
+        """
+        Workable jobs due within the next lookahead_secs seconds, as a
+        list of (job_id, secs_until_due) pairs; secs_until_due is zero
+        or negative for jobs that are already due.
+        """
+        raise NotImplementedError()
+
+    def compress_rows(self, table, columns, after_id=0, limit=1000):
+        """
+        Compress any values in columns that are over the threshold but
+        stored uncompressed, for the (up to) limit rows of table with
+        ids after after_id.
+
+        Returns (last_id, num_updated), where last_id is the id of the
+        last row looked at, or None if there were no rows left.
+        """
+        select = ("SELECT id, " + ', '.join(columns) + " FROM " + table +
+                  " WHERE id > %s ORDER BY id LIMIT %s")
+        self._execute(select, (after_id, limit))
+        rows = self.curs.fetchall()
+        num_updated = 0
+        for row in rows:
+            set_strs = []
+            set_params = []
+            where_strs = ["id = %s"]
+            where_params = [row[0]]
+            for column, value in zip(columns, row[1:]):
+                if value is None or compression.is_compressed(value):
+                    continue
+                compressed = self._compress(value)
+                if compressed is not value:
+                    set_strs.append(column + " = %s")
+                    set_params.append(compressed)
+                    # Leave values that changed under us alone.
+                    where_strs.append(column + " = %s")
+                    where_params.append(value)
+            if set_strs:
+                update = ("UPDATE " + table + " SET " + ', '.join(set_strs) +
+                          " WHERE " + ' AND '.join(where_strs))
+                self._execute(update, tuple(set_params + where_params))
+                num_updated += self.curs.rowcount
+        if not rows:
+            return None, num_updated
+        return rows[-1][0], num_updated
+
+
+class MySQLStorage(Storage):
+    """
+    Storage in MySQL, using named locks (GET_LOCK) to claim jobs.
+    """
+
+    def claim(self, job_id, timeout_secs):
+        acquire_lock = """
+                       SELECT GET_LOCK(%s, %s)
+                       """
+        self._execute(acquire_lock, ("lock_job_%s" % job_id, timeout_secs))
+        return self.curs.fetchone()[0] == 1
+
+    def mark_started(self, job_id):
+        mark = """
+               UPDATE queued_job
+                 SET last_started_at = NOW()
+                 WHERE id = %s
+               """
+        self._execute(mark, (job_id,))
+
+    def record_result(self, job_id, result_code, used_retry=False,
+                      run_token=None):
+        mark_done = """
+                    UPDATE queued_job
+                      SET result_code = %s,
+                          remaining_retries = remaining_retries - %s,
+                          last_finished_at = NOW(),
+                          last_run_token = %s
+                      WHERE id = %s
+                    """
+        self._execute(mark_done, (result_code, int(used_retry), run_token,
+                                  job_id))
+
+    def find_pending(self):
+        select = """
+                 SELECT id
+                 FROM queued_job
+                   WHERE
+                      (result_code IS NULL OR result_code = %s)
+                    AND
+                      remaining_retries > 0
+                    AND
+                      (last_finished_at IS NULL OR
+                       DATE_ADD(last_finished_at,
+                                INTERVAL retry_delay_secs SECOND) <= NOW())
+                 """
+        self._execute(select, (TEMPORARY_FAILURE,))
+        return [r[0] for r in self.curs.fetchall()]
+
+    def find_upcoming(self, lookahead_secs):
+        select = """
+                 SELECT id,
+                        IF(last_finished_at IS NULL,
+                           0,
+                           TIMESTAMPDIFF(SECOND, NOW(),
+                                         DATE_ADD(last_finished_at,
+                                                  INTERVAL retry_delay_secs SECOND)))
+                 FROM queued_job
+                   WHERE
+                      (result_code IS NULL OR result_code = %s)
+                    AND
+                      remaining_retries > 0
+                    AND
+                      (last_finished_at IS NULL OR
+                       DATE_ADD(last_finished_at,
+                                INTERVAL retry_delay_secs SECOND) <=
+                       DATE_ADD(NOW(), INTERVAL %s SECOND))
+                 """
+        self._execute(select, (TEMPORARY_FAILURE, lookahead_secs))
+        return [(r[0], r[1]) for r in self.curs.fetchall()]
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queued_job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    organization_id INTEGER DEFAULT NULL,
+    http_method VARCHAR(10) NOT NULL,
+    url TEXT NOT NULL,
+    body TEXT,
+    timeout_secs INTEGER NOT NULL DEFAULT 60,
+    last_started_at REAL DEFAULT NULL,
+    last_finished_at REAL DEFAULT NULL,
+    last_response TEXT,
+    result_code INTEGER DEFAULT NULL,
+    remaining_retries INTEGER NOT NULL DEFAULT 10,
+    retry_delay_secs INTEGER NOT NULL DEFAULT 60,
+    last_run_token VARCHAR(32) DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS queued_job_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL,
+    msg TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+# How often to retry a claim on a job that is locked by another process.
+SQLITE_CLAIM_POLL_SECS = 0.05
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a local SQLite file, for single node deployments.
+
+    The db runs in WAL mode so that readers and the writer don't block
+    each other.  Times are stored as seconds since the epoch.  Jobs are
+    claimed by taking a POSIX lock on the byte at offset job_id of a
+    lock file next to the db, which (like GET_LOCK) goes away when the
+    claiming process closes the storage or dies.
+    """
+
+    def __init__(self, path, busy_timeout_secs=10):
+        conn = sqlite3.connect(path, timeout=busy_timeout_secs,
+                               isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLITE_SCHEMA)
+        super(SQLiteStorage, self).__init__(conn)
+        self.lock_path = path + ".locks"
+        self._lock_file = None
+
+    def close(self):
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+        super(SQLiteStorage, self).close()
+
+    def _execute(self, query, params=()):
+        self.curs.execute(query.replace("%s", "?"), params)
+
+    def claim(self, job_id, timeout_secs):
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, 'a')
+        give_up_at = time.time() + timeout_secs
+        while True:
+            try:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                            1, job_id)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            if time.time() >= give_up_at:
+                return False
+            time.sleep(SQLITE_CLAIM_POLL_SECS)
+
+    def mark_started(self, job_id):
+        mark = """
+               UPDATE queued_job
+                 SET last_started_at = %s
+                 WHERE id = %s
+               """
+        self._execute(mark, (time.time(), job_id))
+
+    def record_result(self, job_id, result_code, used_retry=False,
+                      run_token=None):
+        mark_done = """
+                    UPDATE queued_job
+                      SET result_code = %s,
+                          remaining_retries = remaining_retries - %s,
+                          last_finished_at = %s,
+                          last_run_token = %s
+                      WHERE id = %s
+                    """
+        self._execute(mark_done, (result_code, int(used_retry), time.time(),
+                                  run_token, job_id))
+
+    def find_pending(self):
+        select = """
+                 SELECT id
+                 FROM queued_job
+                   WHERE
+                      (result_code IS NULL OR result_code = %s)
+                    AND
+                      remaining_retries > 0
+                    AND
+                      (last_finished_at IS NULL OR
+                       last_finished_at + retry_delay_secs <= %s)
+                 """
+        self._execute(select, (TEMPORARY_FAILURE, time.time()))
+        return [r[0] for r in self.curs.fetchall()]
+
+    def find_upcoming(self, lookahead_secs):
+        now = time.time()
+        select = """
+                 SELECT id,
+                        CASE WHEN last_finished_at IS NULL
+                          THEN 0
+                          ELSE last_finished_at + retry_delay_secs - %s
+                        END
+                 FROM queued_job
+                   WHERE
+                      (result_code IS NULL OR result_code = %s)
+                    AND
+                      remaining_retries > 0
+                    AND
+                      (last_finished_at IS NULL OR
+                       last_finished_at + retry_delay_secs <= %s)
+                 """
+        self._execute(select, (now, TEMPORARY_FAILURE, now + lookahead_secs))
+        return [(r[0], r[1]) for r in self.curs.fetchall()]
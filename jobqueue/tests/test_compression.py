@@ -0,0 +1,64 @@
+"""
+Test compression of stored text values.
+"""
+
+import unittest
+
+from nose.tools import ok_, eq_
+
+from jobqueue import compression
+
+
+BIG = '{"stack": "web", "servers": [%s]}' % ', '.join(
+    ['{"name": "web%d", "size": "m1.large"}' % i for i in range(100)])
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_small_values_stored_as_is(self):
+        eq_("GET 200", compression.compress("GET 200"))
+        eq_(None, compression.compress(None))
+
+    def test_round_trip(self):
+        stored = compression.compress(BIG)
+        ok_(compression.is_compressed(stored))
+        ok_(len(stored) < len(BIG) / 4)
+        eq_(BIG, compression.decompress(stored))
+
+    def test_round_trip_unicode(self):
+        value = u"\u2603 snowman " * 200
+        eq_(value, compression.decompress(compression.compress(value)))
+
+    def test_round_trip_keeps_type(self):
+        stored = compression.compress(BIG)
+        eq_(type(BIG), type(compression.decompress(stored)))
+        stored = compression.compress(BIG.decode('ascii'))
+        eq_(type(u""), type(compression.decompress(stored)))
+
+    def test_round_trip_non_ascii_bytes(self):
+        value = u"caf\u00e9 ".encode('utf-8') * 680
+        stored = compression.compress(value)
+        ok_(compression.is_compressed(stored))
+        decompressed = compression.decompress(stored)
+        eq_(str, type(decompressed))
+        eq_(len(value), len(decompressed))
+        eq_(value, decompressed)
+
+    def test_round_trip_invalid_utf8_bytes(self):
+        value = "\xff\xfe not utf-8 " * 200
+        eq_(value, compression.decompress(compression.compress(value)))
+
+    def test_plain_values_read_as_is(self):
+        eq_(BIG, compression.decompress(BIG))
+        eq_(None, compression.decompress(None))
+
+    def test_incompressible_values_stored_as_is(self):
+        value = "".join(chr(33 + (i * 7919) % 94) for i in range(64))
+        eq_(value, compression.compress(value, threshold=16))
+
+    def test_marker_lookalikes_are_compressed(self):
+        for marker in [compression.MARKER, compression.BYTES_MARKER]:
+            value = marker + "not really"
+            stored = compression.compress(value)
+            ok_(stored != value)
+            eq_(value, compression.decompress(stored))
@@ -1,10 +1,18 @@
 """
 Test the queue processor.
+
+Every test runs against each storage engine: SQLite always, MySQL only
+when db.ini has a db-test section.
 """
 
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
 from ConfigParser import SafeConfigParser
+from contextlib import contextmanager
 import os
+import shutil
+import socket
+from StringIO import StringIO
+import tempfile
 import threading
 import time
 import unittest
@@ -14,10 +22,12 @@ from nose.tools import ok_, eq_, timed
 from jobqueue import db, queue_processor
 
 
-def _make_handler_func(resp_code, method):
+def _make_handler_func(resp_code, method, headers=None):
     def _handler(self):
         self.send_response(resp_code)
         self.send_header('Content-type','text/text')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
         self.end_headers()
         self.wfile.write("%s %d" % (method, resp_code))
     return _handler
@@ -27,68 +37,98 @@ def _nolog(*args, **kwargs):
     pass
 
 
-def _make_handler_class(name, resp_code, do_GET=None, do_POST=None):
+def _make_handler_class(name, resp_code, do_GET=None, do_POST=None,
+                        headers=None):
     if do_GET is None:
-        do_GET = _make_handler_func(resp_code, "GET")
+        do_GET = _make_handler_func(resp_code, "GET", headers)
     if do_POST is None:
-        do_POST = _make_handler_func(resp_code, "POST")
+        do_POST = _make_handler_func(resp_code, "POST", headers)
     return type(name, (BaseHTTPRequestHandler, object),
                 dict(do_GET=do_GET,
                      do_POST=do_POST,
                      log_message=_nolog))
 
 
+def _make_timed_handler_class(name, resp_code, call_times):
+    def _handler(self):
+        call_times.append(time.time())
+        _make_handler_func(resp_code, "GET")(self)
+    return _make_handler_class(name, resp_code, do_GET=_handler)
+
+
+@contextmanager
+def _no_deadline(secs):
+    yield
+
+
+def _trickle_or_succeed(self):
+    # /slow trickles bytes, so no single read times out, until the
+    # client goes away; anything else succeeds straight away.
+    self.send_response(200)
+    self.end_headers()
+    if self.path != '/slow':
+        self.wfile.write("GET 200")
+        return
+    try:
+        for _ in range(100):
+            self.wfile.write("x")
+            self.wfile.flush()
+            time.sleep(0.1)
+    except socket.error:
+        # Drop whatever is still buffered for the dead connection, so
+        # finishing the request doesn't fail too.
+        self.wfile = StringIO()
+
+
 def _read_default_db_ini():
     config_parser = SafeConfigParser()
+    fname = os.path.join(os.path.dirname(__file__), '..', '..', 'db.ini')
 
-    with open(os.path.join(os.path.dirname(__file__),
-                           '..',
-                           '..',
-                           'db.ini'),
-              'rb') as fil:
-        config_parser.readfp(fil)
+    if os.path.exists(fname):
+        with open(fname, 'rb') as fil:
+            config_parser.readfp(fil)
 
     return config_parser
 
 
-port = 19898
-
-
-class TestQueueProcessor(unittest.TestCase):
+class _QueueProcessorTests(object):
+    """
+    The tests, run by a TestCase per storage engine, which provides
+    _make_config and _clean_all_tables.
+    """
 
     def setUp(self):
+        self.config = self._make_config()
         db.start_test()
-        self.conn = db.open_conn(_read_default_db_ini())
+        self.store = db.open_storage(self.config)
         self._clean_all_tables()
         self.server = None
         self.thread = None
 
     def tearDown(self):
-        if self.server:
-            self.server.shutdown()
-            self.thread.join()
+        self._stop_server()
         self._clean_all_tables()
-        global port
-        port += 1
+        self.store.close()
         db.end_test()
-        self.conn = None
 
     def _start_server(self, request_handler_class):
-        global port
-        self.server = HTTPServer(('127.0.0.1', port), request_handler_class)
+        self.server = HTTPServer(('127.0.0.1', 0), request_handler_class)
         self.thread = threading.Thread(target=self.server.serve_forever)
         self.thread.start()
 
-    def _clean_all_tables(self):
-        curs = self.conn.cursor()
-        for table in ['queued_job', 'queued_job_log']:
-            curs.execute("TRUNCATE TABLE %s" % table)
+    def _stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.thread.join()
+            self.server = None
 
+    # help protect against deadlock
+    @timed(10)
     def _do_test_job_simple(self, resp_code, result_code, template_str):
-        job_id = self._queue_job('get', '/test')
         self._start_server(_make_handler_class('Handle%d' % resp_code,
                                                resp_code))
-        queue_processor.process_with_pool(1, _read_default_db_ini())
+        job_id = self._queue_job('get', '/test')
+        queue_processor.process_with_pool(1, self.config)
         self._assert_done(job_id, result_code,
                           template_str % (dict(job_id=job_id,
                                                resp_code=resp_code)))
@@ -119,9 +159,20 @@ class TestQueueProcessor(unittest.TestCase):
 
     # help protect against deadlock
     @timed(10)
-    def test_body_received_on_post(self):
-        job_id = self._queue_job('post', '/test', body="this is a test body")
+    def test_success_recorded(self):
+        self._start_server(_make_handler_class('Handle200', 200))
+        job_id = self._queue_job('get', '/test')
+        results = queue_processor.process_with_pool(1, self.config)
+        eq_(1, len(results))
+        ok_(results[0].is_success())
+        eq_("GET 200", self._get(job_id, 'last_response'))
+        eq_(10, self._get(job_id, 'remaining_retries'))
+        ok_(self._get(job_id, 'last_finished_at') >=
+            self._get(job_id, 'last_started_at'))
 
+    # help protect against deadlock
+    @timed(10)
+    def test_body_received_on_post(self):
         def _never_called(other_self):
             ok_(False)
 
@@ -139,7 +190,8 @@ class TestQueueProcessor(unittest.TestCase):
                                                200,
                                                do_GET=_never_called,
                                                do_POST=_do_post))
-        queue_processor.process_with_pool(1, _read_default_db_ini())
+        job_id = self._queue_job('post', '/test', body="this is a test body")
+        queue_processor.process_with_pool(1, self.config)
         self._assert_done(job_id, queue_processor.SUCCESS,
                           "[JOBID %s] Job succeeded: POST 200" % job_id)
 
@@ -149,19 +201,19 @@ class TestQueueProcessor(unittest.TestCase):
     # help protect against deadlock
     @timed(10)
     def test_retries(self):
-        job_id = self._queue_job('get', '/test', remaining_retries=1)
         self._start_server(_make_handler_class('TestRetriesHandler', 503))
-        queue_processor.process_with_pool(1, _read_default_db_ini())
+        job_id = self._queue_job('get', '/test', remaining_retries=1)
+        queue_processor.process_with_pool(1, self.config)
         self._assert_done(
             job_id,
             queue_processor.TEMPORARY_FAILURE,
             "[JOBID %s] Job failed temporarily: GET 503" % job_id)
-        queue_processor.process_with_pool(1, _read_default_db_ini())
-        last_started_at = self._get_last_started_at(job_id)
-        eq_(0, self._get_remaining_retries(job_id))
-        queue_processor.process_with_pool(1, _read_default_db_ini())
-        eq_(0, self._get_remaining_retries(job_id))
-        second_last_started_at = self._get_last_started_at(job_id)
+        queue_processor.process_with_pool(1, self.config)
+        last_started_at = self._get(job_id, 'last_started_at')
+        eq_(0, self._get(job_id, 'remaining_retries'))
+        queue_processor.process_with_pool(1, self.config)
+        eq_(0, self._get(job_id, 'remaining_retries'))
+        second_last_started_at = self._get(job_id, 'last_started_at')
         # the job should not have been re-worked
         eq_(last_started_at, second_last_started_at)
 
@@ -170,23 +222,23 @@ class TestQueueProcessor(unittest.TestCase):
     def test_delay_secs(self):
         # this is crappy time based stuff, and yet it's better than
         # not testing IMHO.
-        job_id = self._queue_job('get', '/test', retry_delay_secs=3)
         self._start_server(_make_handler_class('TestDelaysHandler', 503))
-        queue_processor.process_with_pool(1, _read_default_db_ini())
+        job_id = self._queue_job('get', '/test', retry_delay_secs=3)
+        queue_processor.process_with_pool(1, self.config)
         self._assert_done(
             job_id,
             queue_processor.TEMPORARY_FAILURE,
             "[JOBID %s] Job failed temporarily: GET 503" % job_id)
-        last_started_at = self._get_last_started_at(job_id)
-        queue_processor.process_with_pool(1, _read_default_db_ini())
-        second_last_started_at = self._get_last_started_at(job_id)
+        last_started_at = self._get(job_id, 'last_started_at')
+        queue_processor.process_with_pool(1, self.config)
+        second_last_started_at = self._get(job_id, 'last_started_at')
         # the job should not have been re-worked, as we should be
         # safely within the 3 second delay
         eq_(last_started_at, second_last_started_at)
         time.sleep(5)
-        queue_processor.process_with_pool(1, _read_default_db_ini())
+        queue_processor.process_with_pool(1, self.config)
         # now the job should have been reworked
-        third_last_started_at = self._get_last_started_at(job_id)
+        third_last_started_at = self._get(job_id, 'last_started_at')
         ok_(last_started_at != third_last_started_at)
 
     # help protect against deadlock
@@ -196,10 +248,25 @@ class TestQueueProcessor(unittest.TestCase):
         # not testing IMHO.
         def _sleep_little_baby(other_self):
             time.sleep(5)
-        job_id = self._queue_job('get', '/test', timeout_secs=1)
         self._start_server(_make_handler_class('TestTimeoutHandler', 503,
                                                do_GET=_sleep_little_baby))
-        queue_processor.process_with_pool(1, _read_default_db_ini())
+        job_id = self._queue_job('get', '/test', timeout_secs=1)
+        queue_processor.process_with_pool(1, self.config)
+        self._assert_done(
+            job_id,
+            queue_processor.TEMPORARY_FAILURE,
+            "[JOBID %s] Job failed due to timeout" % job_id)
+
+    # help protect against deadlock
+    @timed(10)
+    def test_total_deadline(self):
+        # the endpoint never leaves the socket idle for long enough to
+        # trip a per-read timeout, but takes far longer than
+        # timeout_secs overall.
+        self._start_server(_make_handler_class('TestTrickleHandler', 200,
+                                               do_GET=_trickle_or_succeed))
+        job_id = self._queue_job('get', '/slow', timeout_secs=1)
+        queue_processor.process_with_pool(1, self.config)
         self._assert_done(
             job_id,
             queue_processor.TEMPORARY_FAILURE,
@@ -214,21 +281,39 @@ class TestQueueProcessor(unittest.TestCase):
             other_self.end_headers()
             other_self.wfile.write("GET 503")
 
-        job_id = self._queue_job('get', '/test', retry_delay_secs=10)
-        eq_(10, self._get_retry_delay_secs(job_id))
         self._start_server(_make_handler_class('TestRetryDelaySeconds', 503,
                                                do_GET=_new_retry_delay_seconds))
-        queue_processor.process_with_pool(1, _read_default_db_ini())
-        eq_(786, self._get_retry_delay_secs(job_id))
+        job_id = self._queue_job('get', '/test', retry_delay_secs=10)
+        eq_(10, self._get(job_id, 'retry_delay_secs'))
+        queue_processor.process_with_pool(1, self.config)
+        eq_(786, self._get(job_id, 'retry_delay_secs'))
+        # not due again for another 786 seconds
+        eq_([], self.store.find_pending())
+
+    # help protect against deadlock
+    @timed(10)
+    def test_bad_retry_delay_header_ignored(self):
+        for bad_value in ['5.5', '']:
+            self._start_server(_make_handler_class(
+                'HandleBadDelay', 503,
+                headers={'x-bitlancer-retry-delay-secs': bad_value}))
+            job_id = self._queue_job('get', '/test', retry_delay_secs=60)
+            results = queue_processor.process_with_pool(1, self.config)
+            ok_(not results[0].is_success())
+            eq_(None, results[0].new_retry_delay_secs)
+            eq_(60, self._get(job_id, 'retry_delay_secs'))
+            eq_(queue_processor.TEMPORARY_FAILURE,
+                self._get(job_id, 'result_code'))
+            self._stop_server()
 
     # help protect against deadlock
     @timed(10)
     def test_multiple_jobs(self):
+        self._start_server(_make_handler_class('TestMultipleJobs', 200))
         job_id_one = self._queue_job('post', '/test', body="this is a test body")
         job_id_two = self._queue_job('get', '/test')
-        self._start_server(_make_handler_class('TestMultipleJobs', 200))
         # make sure that even running with 1 process, we do both jobs
-        queue_processor.process_with_pool(1, _read_default_db_ini())
+        queue_processor.process_with_pool(1, self.config)
         self._assert_done(
             job_id_one,
             queue_processor.SUCCESS,
@@ -238,58 +323,254 @@ class TestQueueProcessor(unittest.TestCase):
             queue_processor.SUCCESS,
             "[JOBID %s] Job succeeded: GET 200" % job_id_two)
 
+    # help protect against deadlock
+    @timed(10)
+    def test_claimed_job_skipped(self):
+        self._start_server(_make_handler_class('Handle200', 200))
+        job_id = self._queue_job('get', '/test')
+        ok_(self.store.claim(job_id, 0))
+        # the worker gives up on the claim after LOCK_TIMEOUT_SECS
+        queue_processor.LOCK_TIMEOUT_SECS = 0
+        try:
+            eq_([None], queue_processor.process_with_pool(1, self.config))
+        finally:
+            queue_processor.LOCK_TIMEOUT_SECS = 10
+        eq_(None, self._get(job_id, 'result_code'))
+        eq_("[JOBID %s] Could not acquire lock on job" % job_id,
+            self._last_log(job_id))
+
+    ##################
+    # RETRY SCHEDULE #
+    ##################
+
+    def _retry_in_secs(self, result, **kwargs):
+        self._start_server(_make_handler_class('Unused', 200))
+        job_id = self._queue_job('get', '/test', **kwargs)
+        job_info = self.store.find_job(job_id)
+        return queue_processor._retry_in_secs(job_info, result)
+
+    def test_retry_delay(self):
+        result = queue_processor.JobResult(status_code=503)
+        eq_(60, self._retry_in_secs(result, retry_delay_secs=60))
+
+    def test_timeout_retry_delay(self):
+        result = queue_processor.JobResult(is_timeout=True)
+        eq_(60, self._retry_in_secs(result, retry_delay_secs=60))
+
+    def test_new_retry_delay_overrides(self):
+        result = queue_processor.JobResult(status_code=503,
+                                           new_retry_delay_secs=5)
+        eq_(5, self._retry_in_secs(result, retry_delay_secs=60))
+
+    def test_no_retry_after_permanent_failure(self):
+        result = queue_processor.JobResult(status_code=500)
+        eq_(None, self._retry_in_secs(result, retry_delay_secs=60))
+
+    def test_no_retry_after_success(self):
+        result = queue_processor.JobResult(status_code=200)
+        eq_(None, self._retry_in_secs(result, retry_delay_secs=60))
+
+    def test_no_retry_after_last_retry(self):
+        result = queue_processor.JobResult(status_code=503)
+        eq_(None, self._retry_in_secs(result, remaining_retries=1))
+
+    # help protect against deadlock
+    @timed(10)
+    def test_forever_retries_on_time(self):
+        call_times = []
+        self._start_server(_make_timed_handler_class('Handle503', 503,
+                                                     call_times))
+        job_id = self._queue_job('get', '/test', remaining_retries=3,
+                                 retry_delay_secs=1)
+        # the reconcile interval is far longer than the test, so retries
+        # can only come from the in-memory schedule.
+        queue_processor.process_forever(1, self.config,
+                                        stop_at=time.time() + 5)
+        eq_(3, len(call_times))
+        for earlier, later in zip(call_times, call_times[1:]):
+            ok_(1 <= later - earlier < 1.5, later - earlier)
+        eq_(0, self._get(job_id, 'remaining_retries'))
+
+    # help protect against deadlock
+    @timed(10)
+    def test_forever_survives_db_errors(self):
+        call_times = []
+        self._start_server(_make_timed_handler_class('Handle200', 200,
+                                                     call_times))
+        job_id = self._queue_job('get', '/test')
+        reconcile = queue_processor._reconcile
+        calls = []
+
+        def _flaky_reconcile(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise Exception("db went away")
+            return reconcile(*args)
+
+        queue_processor._reconcile = _flaky_reconcile
+        try:
+            queue_processor.process_forever(1, self.config,
+                                            reconcile_secs=0.5,
+                                            stop_at=time.time() + 2)
+        finally:
+            queue_processor._reconcile = reconcile
+        ok_(len(calls) > 1)
+        eq_(1, len(call_times))
+        eq_(queue_processor.SUCCESS, self._get(job_id, 'result_code'))
+
+    ##############
+    # SUPERVISOR #
+    ##############
+
+    # help protect against deadlock
+    @timed(10)
+    def test_wedged_worker_killed(self):
+        self._start_server(_make_handler_class('Wedge', 200,
+                                               do_GET=_trickle_or_succeed))
+        wedged_id = self._queue_job('get', '/slow', timeout_secs=1)
+        other_id = self._queue_job('get', '/test')
+        # without the SIGALRM deadline, only the supervisor can free the
+        # worker.
+        deadline = queue_processor._deadline
+        queue_processor._deadline = _no_deadline
+        queue_processor.KILL_GRACE_SECS = 1
+        try:
+            results = queue_processor.process_with_pool(1, self.config)
+        finally:
+            queue_processor._deadline = deadline
+            queue_processor.KILL_GRACE_SECS = 10
+
+        eq_(2, len(results))
+        ok_(results[0].is_timeout)
+        ok_(results[1].is_success())
+        eq_(9, self._get(wedged_id, 'remaining_retries'))
+        self._assert_done(
+            wedged_id,
+            queue_processor.TEMPORARY_FAILURE,
+            "[JOBID %s] Job failed due to timeout" % wedged_id)
+        eq_(1, self._query_one("""SELECT COUNT(*)
+                                    FROM queued_job_log
+                                    WHERE job_id = %s AND msg LIKE %s""",
+                               (wedged_id, '%Killed worker%')))
+        # the pool replaced the killed worker and went on with the batch
+        eq_(queue_processor.SUCCESS, self._get(other_id, 'result_code'))
+
+    # help protect against deadlock
+    @timed(10)
+    def test_wedged_worker_killed_forever(self):
+        self._start_server(_make_handler_class('Wedge', 200,
+                                               do_GET=_trickle_or_succeed))
+        wedged_id = self._queue_job('get', '/slow', timeout_secs=1,
+                                    retry_delay_secs=60)
+        other_id = self._queue_job('get', '/test')
+        deadline = queue_processor._deadline
+        queue_processor._deadline = _no_deadline
+        queue_processor.KILL_GRACE_SECS = 1
+        try:
+            # nothing else is due before stop_at, so only the supervisor
+            # waking up can get the wedged worker killed in time.
+            queue_processor.process_forever(1, self.config,
+                                            stop_at=time.time() + 4)
+        finally:
+            queue_processor._deadline = deadline
+            queue_processor.KILL_GRACE_SECS = 10
+
+        eq_(9, self._get(wedged_id, 'remaining_retries'))
+        self._assert_done(
+            wedged_id,
+            queue_processor.TEMPORARY_FAILURE,
+            "[JOBID %s] Job failed due to timeout" % wedged_id)
+        eq_(queue_processor.SUCCESS, self._get(other_id, 'result_code'))
+
+    def test_killed_after_finishing_not_recorded(self):
+        self._start_server(_make_handler_class('Unused', 200))
+        job_id = self._queue_job('get', '/test')
+        self.store.mark_started(job_id)
+        self.store.record_result(job_id, queue_processor.SUCCESS,
+                                 run_token='run1')
+        eq_(None, queue_processor._record_killed(job_id, 0, 'run1',
+                                                 self.config))
+        eq_(queue_processor.SUCCESS, self._get(job_id, 'result_code'))
+        eq_(10, self._get(job_id, 'remaining_retries'))
+        eq_("[JOBID %s] Job finished before its worker was killed" % job_id,
+            self._last_log(job_id))
+
+    def test_killed_during_retry_recorded(self):
+        # an earlier run's result doesn't count for the killed run, even
+        # if the clock can't tell them apart.
+        self._start_server(_make_handler_class('Unused', 200))
+        job_id = self._queue_job('get', '/test')
+        self.store.mark_started(job_id)
+        self.store.record_result(job_id, queue_processor.TEMPORARY_FAILURE,
+                                 used_retry=True, run_token='run1')
+        self.store.mark_started(job_id)
+        result = queue_processor._record_killed(job_id, 0, 'run2',
+                                                self.config)
+        ok_(result.is_timeout)
+        eq_(8, self._get(job_id, 'remaining_retries'))
+        eq_("[JOBID %s] Job failed due to timeout" % job_id,
+            self._last_log(job_id))
+
     ################
     # HELPER FUNCS #
     ################
 
-    def _get_last_started_at(self, job_id):
-        curs = self.conn.cursor()
-        curs.execute("SELECT last_started_at FROM queued_job WHERE id = %s",
-                     (job_id,))
-        return curs.fetchone()[0]
-
-    def _get_remaining_retries(self, job_id):
-        curs = self.conn.cursor()
-        curs.execute("SELECT remaining_retries FROM queued_job WHERE id = %s",
-                     (job_id,))
-        return curs.fetchone()[0]
+    def _query_one(self, query, params):
+        self.store._execute(query, params)
+        return self.store.curs.fetchone()[0]
 
-    def _get_retry_delay_secs(self, job_id):
-        curs = self.conn.cursor()
-        curs.execute("SELECT retry_delay_secs FROM queued_job WHERE id = %s",
-                     (job_id,))
-        return curs.fetchone()[0]
+    def _get(self, job_id, column):
+        return self._query_one(
+            "SELECT " + column + " FROM queued_job WHERE id = %s", (job_id,))
 
+    def _last_log(self, job_id):
+        return self._query_one("""SELECT msg
+                                    FROM queued_job_log
+                                    WHERE job_id = %s
+                                    ORDER BY id DESC
+                                    LIMIT 1""",
+                               (job_id,))
 
     def _assert_done(self, job_id, status, text):
-        curs = self.conn.cursor()
-        curs.execute("SELECT result_code FROM queued_job WHERE id = %s", (job_id,))
-        result_code = curs.fetchone()[0]
-        eq_(status, result_code)
-        curs.execute("""SELECT msg
-                          FROM queued_job_log
-                          WHERE job_id = %s
-                          ORDER BY id DESC
-                          LIMIT 1""",
-                     (job_id,))
-        msg = curs.fetchone()[0]
-        eq_(text, msg)
+        eq_(status, self._get(job_id, 'result_code'))
+        eq_(text, self._last_log(job_id))
 
     def _queue_job(self, method, uri, body=None, timeout_secs=10, remaining_retries=10,
                    retry_delay_secs=0):
-        curs = self.conn.cursor()
-        global port
-        curs.execute("""
-                     INSERT INTO queued_job
-                       (http_method, url, body, timeout_secs, remaining_retries,
-                        retry_delay_secs)
-                     VALUES
-                       (%s, %s, %s, %s, %s,
-                        %s)
-                     """,
-                     (method, "http://127.0.0.1:%d%s" % (port, uri),
-                      body, timeout_secs, remaining_retries,
-                      retry_delay_secs))
-        curs.execute("SELECT LAST_INSERT_ID()")
-        return curs.fetchone()[0]
+        return self.store.add_job(
+            method, "http://127.0.0.1:%d%s" % (self.server.server_address[1], uri),
+            body=body, timeout_secs=timeout_secs,
+            remaining_retries=remaining_retries,
+            retry_delay_secs=retry_delay_secs)
+
+
+class TestQueueProcessorSQLite(_QueueProcessorTests, unittest.TestCase):
 
+    def _make_config(self):
+        self.dir = tempfile.mkdtemp()
+        config = SafeConfigParser()
+        config.add_section('db-test')
+        config.set('db-test', 'engine', 'sqlite')
+        config.set('db-test', 'path', os.path.join(self.dir, 'queue.db'))
+        return config
+
+    def _clean_all_tables(self):
+        # every test gets a fresh db file
+        pass
+
+    def tearDown(self):
+        super(TestQueueProcessorSQLite, self).tearDown()
+        shutil.rmtree(self.dir)
+
+
+class TestQueueProcessorMySQL(_QueueProcessorTests, unittest.TestCase):
+
+    def _make_config(self):
+        config = _read_default_db_ini()
+        if not config.has_section('db-test'):
+            raise unittest.SkipTest("No db-test section in db.ini")
+        return config
+
+    def _clean_all_tables(self):
+        for table in ['queued_job', 'queued_job_log']:
+            self.store._execute("TRUNCATE TABLE %s" % table)
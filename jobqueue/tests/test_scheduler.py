@@ -0,0 +1,57 @@
+"""
+Test the in-memory due time scheduler.
+"""
+
+import unittest
+
+from nose.tools import ok_, eq_
+
+from jobqueue.scheduler import DueScheduler
+
+
+class _FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestDueScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _FakeClock()
+        self.scheduler = DueScheduler(clock=self.clock)
+
+    def test_empty(self):
+        eq_(None, self.scheduler.next_due())
+        eq_(None, self.scheduler.secs_until_next_due())
+        eq_([], self.scheduler.pop_due())
+
+    def test_pops_in_due_order(self):
+        self.scheduler.schedule_in(1, 30)
+        self.scheduler.schedule_in(2, 10)
+        self.scheduler.schedule_in(3, 20)
+        eq_(10, self.scheduler.secs_until_next_due())
+        self.clock.now += 25
+        eq_([2, 3], self.scheduler.pop_due())
+        eq_(1, len(self.scheduler))
+        eq_(5, self.scheduler.secs_until_next_due())
+
+    def test_overdue_is_due_now(self):
+        self.scheduler.schedule_in(1, -15)
+        eq_(0, self.scheduler.secs_until_next_due())
+        eq_([1], self.scheduler.pop_due())
+
+    def test_reschedule_replaces_due_time(self):
+        self.scheduler.schedule_in(1, 10)
+        self.scheduler.schedule_in(1, 60)
+        eq_(1, len(self.scheduler))
+        self.clock.now += 30
+        eq_([], self.scheduler.pop_due())
+        ok_(1 in self.scheduler)
+        self.clock.now += 30
+        eq_([1], self.scheduler.pop_due())
+        ok_(1 not in self.scheduler)
+        eq_(None, self.scheduler.next_due())
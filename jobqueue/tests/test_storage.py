@@ -0,0 +1,141 @@
+"""
+Test the SQLite storage backend.
+"""
+
+from multiprocessing import Process, Queue
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import ok_, eq_
+
+from jobqueue import compression
+from jobqueue.storage import (SQLiteStorage, SUCCESS, PERMANENT_FAILURE,
+                              TEMPORARY_FAILURE)
+
+
+def _try_claim(path, job_id, claimed):
+    store = SQLiteStorage(path)
+    try:
+        claimed.put(store.claim(job_id, 0))
+    finally:
+        store.close()
+
+
+class TestSQLiteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'queue.db')
+        self.store = SQLiteStorage(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def _claimed_elsewhere(self, job_id):
+        claimed = Queue()
+        proc = Process(target=_try_claim, args=(self.path, job_id, claimed))
+        proc.start()
+        proc.join()
+        return claimed.get()
+
+    def test_wal_mode(self):
+        self.store.curs.execute("PRAGMA journal_mode")
+        eq_('wal', self.store.curs.fetchone()[0])
+
+    def test_add_and_find_job(self):
+        job_id = self.store.add_job('post', 'http://example.com/', body='hi',
+                                    timeout_secs=5)
+        job_info = self.store.find_job(job_id)
+        eq_(job_id, job_info.id)
+        eq_('post', job_info.http_method)
+        eq_('hi', job_info.body)
+        eq_(5, job_info.timeout_secs)
+        eq_(None, job_info.result_code)
+        eq_(None, self.store.find_job(job_id + 1))
+
+    def test_find_pending(self):
+        waiting = self.store.add_job('get', 'http://example.com/',
+                                     retry_delay_secs=3600)
+        ready = self.store.add_job('get', 'http://example.com/',
+                                   retry_delay_secs=0)
+        done = self.store.add_job('get', 'http://example.com/')
+        used_up = self.store.add_job('get', 'http://example.com/',
+                                     remaining_retries=1, retry_delay_secs=0)
+        eq_([waiting, ready, done, used_up], self.store.find_pending())
+
+        self.store.record_result(waiting, TEMPORARY_FAILURE, used_retry=True)
+        self.store.record_result(ready, TEMPORARY_FAILURE, used_retry=True)
+        self.store.record_result(done, SUCCESS)
+        self.store.record_result(used_up, TEMPORARY_FAILURE, used_retry=True)
+        eq_([ready], self.store.find_pending())
+        eq_(9, self.store.find_job(ready).remaining_retries)
+        eq_(10, self.store.find_job(done).remaining_retries)
+
+        upcoming = dict(self.store.find_upcoming(7200))
+        eq_(set([waiting, ready]), set(upcoming))
+        ok_(3590 < upcoming[waiting] <= 3600)
+        ok_(upcoming[ready] <= 0)
+
+    def test_update_job(self):
+        job_id = self.store.add_job('get', 'http://example.com/')
+        self.store.update_job(job_id, last_response='GET 503',
+                              retry_delay_secs=786)
+        job_info = self.store.find_job(job_id)
+        eq_(786, job_info.retry_delay_secs)
+        eq_('http://example.com/', job_info.url)
+        self.store.record_result(job_id, PERMANENT_FAILURE, used_retry=True)
+        eq_([], self.store.find_pending())
+
+    def test_claim_is_exclusive(self):
+        job_id = self.store.add_job('get', 'http://example.com/')
+        ok_(self._claimed_elsewhere(job_id))
+        ok_(self.store.claim(job_id, 0))
+        ok_(not self._claimed_elsewhere(job_id))
+        ok_(self._claimed_elsewhere(job_id + 1))
+        self.store.close()
+        ok_(self._claimed_elsewhere(job_id))
+        self.store = SQLiteStorage(self.path)
+
+    def _raw_body(self, job_id):
+        self.store.curs.execute("SELECT body FROM queued_job WHERE id = ?",
+                                (job_id,))
+        return self.store.curs.fetchone()[0]
+
+    def test_large_bodies_compressed(self):
+        body = '{"key": "value"}' * 1000
+        job_id = self.store.add_job('post', 'http://example.com/', body=body)
+        ok_(compression.is_compressed(self._raw_body(job_id)))
+        eq_(body, self.store.find_job(job_id).body)
+
+    def test_compress_rows(self):
+        body = '{"key": "value"}' * 1000
+        self.store.curs.execute(
+            "INSERT INTO queued_job (http_method, url, body) VALUES (?, ?, ?)",
+            ('post', 'http://example.com/', body))
+        old_id = self.store.curs.lastrowid
+        small_id = self.store.add_job('post', 'http://example.com/', body='x')
+        new_id = self.store.add_job('post', 'http://example.com/', body=body)
+        eq_(body, self._raw_body(old_id))
+
+        eq_((small_id, 1),
+            self.store.compress_rows('queued_job', ['body', 'last_response'],
+                                     limit=2))
+        eq_((new_id, 0),
+            self.store.compress_rows('queued_job', ['body', 'last_response'],
+                                     after_id=small_id))
+        eq_((None, 0),
+            self.store.compress_rows('queued_job', ['body', 'last_response'],
+                                     after_id=new_id))
+        ok_(compression.is_compressed(self._raw_body(old_id)))
+        eq_(body, self.store.find_job(old_id).body)
+        eq_('x', self._raw_body(small_id))
+
+    def test_log(self):
+        job_id = self.store.add_job('get', 'http://example.com/')
+        self.store.log(job_id, "hello")
+        self.store.curs.execute(
+            "SELECT msg FROM queued_job_log WHERE job_id = ?", (job_id,))
+        eq_([("hello",)], self.store.curs.fetchall())
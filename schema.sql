@@ -11,6 +11,7 @@ CREATE TABLE `queued_job` (
 	`result_code` int(11) DEFAULT NULL COMMENT 'HTTP status code',
 	`remaining_retries` int(11) NOT NULL DEFAULT '10' COMMENT 'Number of remaining retries before the job is marked as failed',
 	`retry_delay_secs` int(11) NOT NULL DEFAULT '60' COMMENT 'Do not retry this job for this number of seconds',
+	`last_run_token` varchar(32) DEFAULT NULL COMMENT 'Identifies the run that recorded the last result',
 	PRIMARY KEY (`id`))
 
 CREATE TABLE IF NOT EXISTS `queued_job_log` (